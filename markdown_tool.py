@@ -5,13 +5,21 @@ Simple script to download images and replace image links in markdown documents.
 """
 
 import argparse
-
-from io import StringIO
-from itertools import permutations
+import logging
+import os
+import re
+import sys
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob, has_magic
+from importlib.util import find_spec
+from logging.handlers import QueueHandler, QueueListener
 from mimetypes import types_map
+from os.path import lexists
 from pathlib import Path
+from queue import SimpleQueue
 from time import strftime
-from typing import List
+from typing import FrozenSet, List, Optional
 
 from pkg.formatters.html import HTMLFormatter
 from pkg.formatters.simple import SimpleFormatter
@@ -20,16 +28,28 @@ from pkg.transformers.md.transformer import ArticleTransformer as MarkdownArticl
 from pkg.transformers.html.transformer import ArticleTransformer as HTMLArticleTransformer
 from pkg.www_tools import is_url, get_base_url, get_filename_from_url, download_from_url
 
-try:
-    from pkg.formatters.pdf import PDFFormatter
-except ModuleNotFoundError:
-    PDFFormatter = None
-
 
 __version__ = '0.0.7'
 
+logger = logging.getLogger(__name__)
+
 TRANSFORMERS = [MarkdownArticleTransformer, HTMLArticleTransformer]
-FORMATTERS = [SimpleFormatter, HTMLFormatter, PDFFormatter]
+
+_TRANSFORMER_BY_FORMAT = {tr.format: tr for tr in TRANSFORMERS if tr is not None}
+
+
+def _load_pdf_formatter():
+    # WeasyPrint loads Pango and Cairo, which is slow, so it's imported only when PDF is requested.
+    from pkg.formatters.pdf import PDFFormatter
+
+    return PDFFormatter
+
+
+_FORMATTER_LOADERS = {
+    SimpleFormatter.format: lambda: SimpleFormatter,
+    HTMLFormatter.format: lambda: HTMLFormatter,
+    'pdf': _load_pdf_formatter,
+}
 
 del types_map['.jpe']
 
@@ -39,25 +59,34 @@ def transform_article(article_path: str, input_format_list: List[str],
     """
     Download images and fix URL's.
     """
-    transformers = [tr for ifmt in input_format_list
-                    for tr in TRANSFORMERS if tr is not None and tr.format == ifmt]
+    transformers = [_TRANSFORMER_BY_FORMAT[ifmt] for ifmt in input_format_list]
 
-    with open(article_path, 'r', encoding=encoding) as article_file:
-        result = StringIO(article_file.read())
+    # Decoded in one pass: text mode would add a newline translation pass over the whole article.
+    with open(article_path, 'rb') as article_file:
+        result = article_file.read().decode(encoding)
 
     for transformer in transformers:
-        lines = transformer(result, img_downloader).run()
-        result = StringIO(''.join(lines))
+        result = transformer(result, img_downloader).run()
 
-    return result.read()
+    return result
 
 
-def get_formatter(output_format: str):
-    formatter = [f for f in FORMATTERS if f is not None and f.format == output_format]
-    assert len(formatter) == 1
-    formatter = formatter[0]
+def _parse_input_format(input_format: str) -> List[str]:
+    """
+    Split the input format into the formats of the transformers to run, e.g. "md+html" -> ["md", "html"].
+    """
 
-    return formatter
+    input_format_list = input_format.split('+')
+    for ifmt in input_format_list:
+        if ifmt not in _TRANSFORMER_BY_FORMAT:
+            raise argparse.ArgumentTypeError(f'unknown input format "{ifmt}", '
+                                             f'choose from {", ".join(_TRANSFORMER_BY_FORMAT)}')
+
+    return input_format_list
+
+
+def get_formatter(output_format: str):
+    return _FORMATTER_LOADERS[output_format]()
 
 
 def get_article_output_path(article_path: Path, explicit_output_path: Path,
@@ -68,7 +97,7 @@ def get_article_output_path(article_path: Path, explicit_output_path: Path,
     else:
         article_output_basename = f'{article_output_stem}{output_postfix}.{file_format}'
         article_output_path = article_path.parent.joinpath(article_output_basename)
-        if article_output_path.is_file() and not remove_source:
+        if lexists(article_output_path) and not remove_source:
             article_output_basename = f'{article_output_stem}{output_postfix}_{strftime("%Y%m%d_%H%M%S")}.{file_format}'
             article_output_path = article_path.parent.joinpath(article_output_basename)
 
@@ -80,20 +109,71 @@ def format_article(article_out_path: str, article_text: str, formatter) -> None:
     Save article in the selected format.
     """
 
-    print(f'Writing file into "{article_out_path}"...')
+    logger.info('Writing file into "%s"...', article_out_path)
 
     with open(article_out_path, 'wb') as outfile:
-        outfile.write(formatter.write(article_text))
+        formatter.write_to(article_text, outfile)
 
 
-def main(arguments):
+def read_skip_list(skip_list: Optional[str], encoding: str) -> FrozenSet[str]:
     """
-    Entrypoint.
+    Parse comma-separated skip list, or read it from a file, if it has a leading '@'.
     """
 
-    print(f'Markdown tool version {__version__} started...')
+    if skip_list is None:
+        return frozenset()
+
+    if skip_list.startswith('@'):
+        skip_list = skip_list[1:]
+        logger.info('Reading skip list from a file "%s"...', skip_list)
+        with open(Path(skip_list).expanduser(), 'r', encoding=encoding) as fsl:
+            skip_list = fsl.readlines()
+    else:
+        skip_list = skip_list.split(',')
+
+    return frozenset(s.strip() for s in skip_list if s.strip())
+
+
+def get_article_links(article_link: str, input_format: str, output_postfix: str) -> List[str]:
+    """
+    Expand directory or glob pattern into the list of articles; URL or file is returned as is.
+    """
+
+    if is_url(article_link):
+        return [article_link]
+
+    article_path = Path(article_link).expanduser()
+    if article_path.is_dir():
+        paths = article_path.rglob(f'*.{input_format}')
+    elif has_magic(article_link) and not article_path.exists():
+        # Existing file name may contain glob special characters, e.g. "notes [draft].md".
+        paths = glob(os.path.expanduser(article_link), recursive=True)
+    else:
+        return [article_link]
+
+    # Outputs of the previous runs, including the timestamped ones, are not processed again.
+    output_stem_re = re.compile(rf'{re.escape(output_postfix)}(_\d{{8}}_\d{{6}})?$')
+    article_links = sorted(str(p) for p in paths
+                           if Path(p).is_file() and not (output_postfix and output_stem_re.search(Path(p).stem)))
+    if not article_links:
+        raise FileNotFoundError(f'No articles were found in "{article_link}"')
+
+    return article_links
+
+
+def get_images_dir(article_path: Path, output_dir: Path, arguments) -> Path:
+    if arguments.images_public_dir:
+        return Path(arguments.images_public_dir)
+
+    return output_dir.joinpath(article_path.stem.replace(' ', '_') if arguments.use_article_name_as_images_dir
+                               else arguments.images_dirname)
+
+
+def process_article(article_link: str, arguments) -> None:
+    """
+    Download images of the article, fix links and save it in the output format.
+    """
 
-    article_link = arguments.article_file_path_or_url
     if is_url(article_link):
         timeout = arguments.downloading_timeout
         if timeout < 0:
@@ -107,61 +187,99 @@ def main(arguments):
     else:
         response = None
         article_path = Path(article_link).expanduser()
-    print(f'File "{article_path}" will be processed...')
+    logger.info('File "%s" will be processed...', article_path)
 
     article_formatter = get_formatter(arguments.output_format)
     article_output_path = get_article_output_path(article_path, arguments.output_path,
                                                   article_formatter.format, arguments.remove_source,
                                                   output_postfix=arguments.output_postfix)
-    print(f'The new file will be save to "{article_output_path}"...')
-
-    skip_list = arguments.skip_list
-    if isinstance(skip_list, str):
-        if skip_list.startswith('@'):
-            skip_list = skip_list[1:]
-            print(f'Reading skip list from a file "{skip_list}"...')
-            with open(Path(skip_list).expanduser(), 'r', encoding=arguments.encoding) as fsl:
-                skip_list = [s.strip() for s in fsl.readlines()]
-        else:
-            skip_list = [s.strip() for s in skip_list.split(',')]
-
-    if str(arguments.images_public_dir):
-        images_dir = Path(arguments.images_public_dir)
-    else:
-        images_dir = article_output_path.parent.joinpath(
-            article_path.stem.replace(' ', '_') if arguments.use_article_name_as_images_dir
-            else arguments.images_dirname)
+    logger.info('The new file will be save to "%s"...', article_output_path)
 
-    img_downloader = ImageDownloader(
-        images_dir=images_dir,
+    with ImageDownloader(
+        images_dir=get_images_dir(article_path, article_output_path.parent, arguments),
         article_base_url=get_base_url(response),
-        skip_list=skip_list,
+        skip_list=arguments.skip_list,
         skip_all_errors=arguments.skip_all_incorrect,
         downloading_timeout=arguments.downloading_timeout,
         deduplication=arguments.dedup_with_hash,
         skip_on_existing_filename=arguments.skip_on_existing_filename,
         overwrite=arguments.overwrite,
-    )
-
-    result = transform_article(article_path, arguments.input_format.split('+'), img_downloader, arguments.encoding)
+        max_workers=arguments.max_downloads,
+        perceptual_deduplication=arguments.perceptual_dedup,
+        refresh_if_modified=arguments.refresh_if_modified,
+    ) as img_downloader:
+        result = transform_article(article_path, arguments.input_format, img_downloader,
+                                   arguments.encoding)
 
     format_article(article_output_path, result, article_formatter)
 
     if arguments.remove_source and article_path.is_file():
-        print(f'Removing source file "{article_path}"...')
+        logger.info('Removing source file "%s"...', article_path)
         article_path.unlink()
 
-    print('Processing finished successfully...')
+
+def setup_logging() -> QueueListener:
+    """
+    Print log messages to stdout from a single thread.
+
+    Download threads only put records into the queue, instead of contending for stdout.
+    """
+
+    queue = SimpleQueue()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[QueueHandler(queue)], force=True)
+    listener = QueueListener(queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+
+    return listener
+
+
+def _setup_worker_logging() -> None:
+    # Worker process can't use the queue listener thread of the main process.
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout, force=True)
+
+
+def _process_article_in_worker(article_link: str, arguments: dict) -> None:
+    process_article(article_link, argparse.Namespace(**arguments))
+
+
+def main(arguments):
+    """
+    Entrypoint.
+    """
+
+    logger.info('Markdown tool version %s started...', __version__)
+
+    # Parsed once here, not by every article.
+    arguments.skip_list = read_skip_list(arguments.skip_list, arguments.encoding)
+    article_links = get_article_links(arguments.article_file_path_or_url, arguments.input_format[0],
+                                      arguments.output_postfix)
+    if len(article_links) == 1:
+        process_article(article_links[0], arguments)
+    else:
+        if arguments.output_path:
+            raise ValueError('"--output-path" can\'t be used with several articles')
+
+        logger.info('%d articles will be processed...', len(article_links))
+        # Articles are processed in parallel, each in its own process. Articles may share an images directory,
+        # so image downloader reserves image file names atomically.
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(article_links)),
+                                 initializer=_setup_worker_logging) as executor:
+            futures = [executor.submit(_process_article_in_worker, article_link, vars(arguments))
+                       for article_link in article_links]
+            for future in as_completed(futures):
+                future.result()
+
+    logger.info('Processing finished successfully...')
 
 
 if __name__ == '__main__':
-    in_format_list = [f.format for f in TRANSFORMERS if f is not None]
-    in_format_list = [*in_format_list, *('+'.join(i) for i in permutations(in_format_list))]
-    out_format_list = [f.format for f in FORMATTERS if f is not None]
+    # PDF is offered only if WeasyPrint is installed; find_spec() checks it without the slow import.
+    out_format_list = [fmt for fmt in _FORMATTER_LOADERS if fmt != 'pdf' or find_spec('weasyprint') is not None]
 
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('article_file_path_or_url', type=str,
-                        help='path to the article file in the Markdown format')
+                        help=('path to the article file in the Markdown format; '
+                              'directory or glob pattern to process several articles in parallel'))
     parser.add_argument('-a', '--skip-all-incorrect', default=False, action='store_true',
                         help='skip all incorrect images')
     parser.add_argument('-d', '--images-dirname', type=str, default='images',
@@ -176,13 +294,20 @@ if __name__ == '__main__':
                               'will override "--images-dirname" and "--use-article-name-as-images-dir"; '
                               'note that output file will still use relative paths in light of markdown portability.'))
     parser.add_argument('-s', '--skip-list', default=None,
-                        help='skip URL\'s from the comma-separated list (or file with a leading \'@\')')
+                        help=('skip URL\'s from the comma-separated list (or file with a leading \'@\'); '
+                              'URL\'s without a path skip the whole host'))
     parser.add_argument('-t', '--downloading-timeout', type=float, default=-1,
                         help='how many seconds to wait before downloading will be failed')
+    parser.add_argument('-j', '--max-downloads', type=int, default=5,
+                        help='how many images may be downloaded simultaneously')
     parser.add_argument('-D', '--dedup-with-hash', default=False, action='store_true',
                         help='Deduplicate images, using content hash')
-    parser.add_argument('-I', '--input-format', default='md', choices=in_format_list,
-                        help='input format')
+    parser.add_argument('--perceptual-dedup', default=False, action='store_true',
+                        help=('Deduplicate visually similar (resized, recompressed) images, using dHash; '
+                              'requires "imagehash" package'))
+    parser.add_argument('-I', '--input-format', default='md', type=_parse_input_format,
+                        help=(f'input format: {", ".join(_TRANSFORMER_BY_FORMAT)}, '
+                              'several formats may be joined with "+", e.g. "md+html"'))
     parser.add_argument('-O', '--output-format', default=out_format_list[0], choices=out_format_list,
                         help='output format')
     parser.add_argument('-R', '--remove-source', default=False, action='store_true',
@@ -193,6 +318,9 @@ if __name__ == '__main__':
                         help='postfix for article output file name')
     parser.add_argument('--skip-on-existing-filename', default=False, action='store_true',
                         help='skip on existing filename')
+    parser.add_argument('--refresh-if-modified', default=False, action='store_true',
+                        help=('download an image with an existing filename only if it was modified '
+                              'since the file was saved'))
     parser.add_argument('--use-article-name-as-images-dir', default=False, action='store_true',
                         help=('Use article file name as the folder name to store images, '
                               'will override "--images-dir-name"'))
@@ -201,4 +329,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    main(args)
+    log_listener = setup_logging()
+    try:
+        main(args)
+    finally:
+        log_listener.stop()
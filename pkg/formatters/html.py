@@ -2,8 +2,12 @@
 HTML formatter.
 """
 
+from io import BytesIO
+
 from markdown import markdown
 
+from pkg.string_tools import encode_by_chunks
+
 
 class HTMLFormatter:
     """
@@ -14,5 +18,12 @@ class HTMLFormatter:
 
     @staticmethod
     def write(lines):
-        md = markdown(lines, output_format='html')
-        return f'<html>\n<head></head>\n<body>\n{md}\n</body>\n</html>'.encode()
+        with BytesIO() as result:
+            HTMLFormatter.write_to(lines, result)
+            return result.getvalue()
+
+    @staticmethod
+    def write_to(lines, out_file):
+        out_file.write(b'<html>\n<head></head>\n<body>\n')
+        out_file.writelines(encode_by_chunks(markdown(lines, output_format='html')))
+        out_file.write(b'\n</body>\n</html>')
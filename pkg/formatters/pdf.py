@@ -2,6 +2,8 @@
 PDF formatter.
 """
 
+from io import BytesIO
+
 from markdown import markdown
 import weasyprint
 
@@ -19,8 +21,9 @@ class PDFFormatter:
 
     @staticmethod
     def write(lines):
-        return weasyprint.HTML(string=markdown(lines, output_format='html'),
-                               url_fetcher=PDFFormatter._fetcher).write_pdf()
+        with BytesIO() as result:
+            PDFFormatter.write_to(lines, result)
+            return result.getvalue()
 
         # with BytesIO() as result:
         #     pisa.pisaDocument(markdown(''.join(lines), output_format='html'), dest=result,
@@ -32,3 +35,8 @@ class PDFFormatter:
         # return data
 
         # pdfkit.from_string(markdown(''.join(lines), output_format='html'), 'fuck.pdf')
+
+    @staticmethod
+    def write_to(lines, out_file):
+        weasyprint.HTML(string=markdown(lines, output_format='html'),
+                        url_fetcher=PDFFormatter._fetcher).write_pdf(out_file)
@@ -2,6 +2,8 @@
 Simple formatter.
 """
 
+from pkg.string_tools import encode_by_chunks
+
 
 class SimpleFormatter:
     """
@@ -13,3 +15,7 @@ class SimpleFormatter:
     @staticmethod
     def write(lines):
         return lines.encode('utf8')
+
+    @staticmethod
+    def write_to(lines, out_file):
+        out_file.writelines(encode_by_chunks(lines))
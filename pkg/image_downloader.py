@@ -1,12 +1,142 @@
 import hashlib
+import logging
 import os
 
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 from time import strftime
-from typing import Optional, List
+from typing import Iterable, NamedTuple, Optional, List
+from urllib.parse import urlparse
+from uuid import uuid4
 
-from pkg.www_tools import is_url, get_filename_from_url, download_from_url
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from pkg.www_tools import is_url, get_filename_from_url, download_from_url, is_modified_since
+
+logger = logging.getLogger(__name__)
+
+# The fastest available hash for the deduplication fingerprints: xxHash3, BLAKE3 or, from the stdlib, BLAKE2b.
+try:
+    from xxhash import xxh3_128 as _new_content_hasher
+except ImportError:
+    try:
+        from blake3 import blake3 as _new_content_hasher
+    except ImportError:
+        _new_content_hasher = partial(hashlib.blake2b, digest_size=16)
+
+# Images are streamed to the disk by chunks of this size, instead of being kept in memory.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Maximum Hamming distance between difference hashes of the images, which are considered similar.
+PERCEPTUAL_HASH_MAX_DISTANCE = 6
+# Difference hash is computed in grayscale and ignores the image proportions, so similar images must
+# also have close aspect ratios (relative difference) and mean colours (per RGB channel).
+PERCEPTUAL_ASPECT_RATIO_TOLERANCE = 0.03
+PERCEPTUAL_COLOUR_MAX_DISTANCE = 16
+
+
+def _get_file_hash(file_path: os.PathLike) -> bytes:
+    """
+    Get image content fingerprint for the deduplication.
+
+    No cryptographic strength is needed here, so the fastest available hash is used.
+    """
+
+    hasher = _new_content_hasher()
+    # Chunks are read into the same buffer and passed to the hasher without copying.
+    buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+    with open(file_path, 'rb', buffering=0) as img_file:
+        while True:
+            size = img_file.readinto(buffer)
+            if not size:
+                break
+            hasher.update(buffer[:size])
+
+    return hasher.digest()
+
+
+class _PerceptualHash(NamedTuple):
+    dhash: object
+    aspect_ratio: float
+    mean_colour: tuple
+    pixel_count: int
+
+
+def _get_perceptual_hash(file_path: os.PathLike) -> Optional[_PerceptualHash]:
+    """
+    Get image difference hash, aspect ratio and mean colour, which are close for resized or recompressed
+    copies of the image.
+
+    :return None if the file can't be decoded as an image.
+    """
+
+    import imagehash
+    from PIL import Image
+
+    try:
+        with Image.open(file_path) as img:
+            width, height = img.size
+            mean_colour = img.convert('RGB').resize((1, 1), Image.BOX).getpixel((0, 0))
+            return _PerceptualHash(imagehash.dhash(img, hash_size=8), width / height, mean_colour, width * height)
+    except (OSError, ValueError, ZeroDivisionError, Image.DecompressionBombError):
+        return None
+
+
+def _create_session(pool_maxsize: int) -> requests.Session:
+    """
+    Create HTTP session, which keeps connections alive and retries failed requests.
+    """
+
+    session = requests.Session()
+    # "Retry-After" of a throttling server isn't honoured: it could block a download thread for any time,
+    # ignoring the downloading timeout.
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize,
+                          max_retries=Retry(total=3, backoff_factor=0.3,
+                                            status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False,
+                                            respect_retry_after_header=False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+# Images are mostly hosted on a few servers, so keeping the connections alive saves a TCP (and TLS)
+# handshake per image. The session is shared by all the downloaders, which don't ask for their own one.
+SHARED_SESSION_POOL_SIZE = 64
+_SHARED_SESSION = _create_session(SHARED_SESSION_POOL_SIZE)
+
+
+class _DownloadState:
+    """
+    Saved images and their indexes, built by a single download_images() call.
+    """
+
+    def __init__(self, existing_filenames: set):
+        self.existing_filenames = existing_filenames
+        self.replacement_mapping = {}
+        # Document path -> URL, reverse index for the replacement mapping.
+        self.path_to_url = {}
+        self.hash_to_path_mapping = {}
+        # Content size -> saved images with this size, which weren't hashed yet.
+        self.size_to_unhashed_filenames = {}
+        self.perceptual_hash_to_path = []
+        # Filename -> URL of the first image in the list with this URL basename.
+        self.filename_owners = {}
+
+    def forget_image(self, img_filename: str):
+        """
+        Remove saved image from the content indexes, before its file is replaced.
+        """
+
+        self.perceptual_hash_to_path = [(h, f) for h, f in self.perceptual_hash_to_path if f != img_filename]
+        for filenames in self.size_to_unhashed_filenames.values():
+            if img_filename in filenames:
+                filenames.remove(img_filename)
+        for content_hash in [h for h, f in self.hash_to_path_mapping.items() if f == img_filename]:
+            del self.hash_to_path_mapping[content_hash]
 
 
 class ImageDownloader:
@@ -16,119 +146,417 @@ class ImageDownloader:
 
     def __init__(self, images_dir: os.PathLike,
                  article_base_url: str = '',
-                 skip_list: Optional[List[str]] = None,
+                 skip_list: Optional[Iterable[str]] = None,
                  downloading_timeout: float = -1,
                  skip_all_errors: bool = False,
                  deduplication: bool = False,
                  skip_on_existing_filename: bool = False,
-                 overwrite: bool = False):
+                 overwrite: bool = False,
+                 max_workers: int = 5,
+                 perceptual_deduplication: bool = False,
+                 refresh_if_modified: bool = False,
+                 isolated_session: bool = False):
         self._images_dir = Path(images_dir)
+        # Documents refer to images relative to the article, by the images directory name only.
+        self._document_images_dir = Path(self._images_dir.name)
         self._article_base_url = article_base_url
-        self._skip_list = set(skip_list) if skip_list is not None else []
+        self._skip_list = frozenset(skip_list or ())
+        # Skip list URLs without a path skip all images from the host.
+        self._skip_hosts = frozenset(url.netloc for url in map(urlparse, self._skip_list)
+                                     if url.netloc and not url.path.strip('/'))
         self._skip_all_errors = skip_all_errors
         self._downloading_timeout = downloading_timeout if downloading_timeout > 0 else None
         self._deduplication = deduplication
         self._skip_on_existing_filename = skip_on_existing_filename
         self._overwrite = overwrite
+        self._max_workers = max_workers
+        self._perceptual_deduplication = perceptual_deduplication
+        self._refresh_if_modified = refresh_if_modified
+
+        if perceptual_deduplication:
+            # imagehash loads NumPy and Pillow, which is slow, so it's imported only when it's needed.
+            try:
+                import imagehash  # noqa: F401
+            except ModuleNotFoundError as e:
+                raise ModuleNotFoundError('Perceptual deduplication requires "imagehash" and "Pillow" packages') \
+                    from e
+
+        # Every download thread needs its own connection to keep it alive, so a pool smaller than
+        # the thread pool would discard connections.
+        if isolated_session or max_workers > SHARED_SESSION_POOL_SIZE:
+            self._session = _create_session(pool_maxsize=max(max_workers, 1))
+        else:
+            self._session = _SHARED_SESSION
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying HTTP session, if it isn't shared.
+        """
+
+        if self._session is not _SHARED_SESSION:
+            self._session.close()
 
     def download_images(self, images: List[str]) -> dict:
         """
         Download and save images from the list.
 
-        :return URL -> file path mapping.
+        :return URL -> file path mapping, longest URLs first.
         """
-        self._images_dir.mkdir(parents=True, exist_ok=True)
+        # Every URL is downloaded once, even if it's repeated in the list.
+        images = list(dict.fromkeys(images))
 
-        replacement_mapping = {}
-        hash_to_path_mapping = {}
-        for img_num, img_url in enumerate(images):
-            assert img_url not in replacement_mapping.keys(), f'BUG: already downloaded image "{img_url}"...'
+        # One directory listing instead of a stat() call per image.
+        try:
+            with os.scandir(self._images_dir) as entries:
+                existing_filenames = {entry.name for entry in entries if entry.is_file()}
+            images_dir_exists = True
+        except FileNotFoundError:
+            existing_filenames = set()
+            images_dir_exists = False
+
+        state = _DownloadState(existing_filenames)
+        pending = self._select_images(images, state)
+
+        # The directory is created only if something will be saved into it.
+        if pending and not images_dir_exists:
+            self._images_dir.mkdir(parents=True, exist_ok=True)
 
-            if img_url in self._skip_list:
-                print(f'Image {img_num + 1} ["{img_url}"] was skipped, because it\'s in the skip list...')
+        # Downloads are network-bound, so they run concurrently and are streamed into temporary files;
+        # all the bookkeeping is done in this thread, as the futures complete, so the state needs no locking.
+        with ThreadPoolExecutor(max_workers=max(1, min(self._max_workers, len(pending)))) as executor:
+            futures = {}
+            for img_num, img_url, cached_img_filename in pending:
+                logger.info('Downloading image %d of %d from "%s"...', img_num + 1, len(images), img_url)
+                futures[executor.submit(self._download_image, img_url, cached_img_filename)] = \
+                    img_num, img_url, cached_img_filename
+
+            # Temporary files of the unprocessed downloads are removed on any error, including interruption.
+            try:
+                for future in as_completed(futures):
+                    self._complete_download(state, future, *futures[future])
+            except BaseException:
+                ImageDownloader._discard_downloads(futures)
+                raise
+
+        # Transformers replace URLs in the mapping order, so the longest ones go first: a URL which is
+        # a prefix of another one must not be replaced inside it.
+        return dict(sorted(state.replacement_mapping.items(), key=lambda item: len(item[0]), reverse=True))
+
+    def _complete_download(self, state: '_DownloadState', future, img_num: int, img_url: str,
+                           cached_img_filename: Optional[str]):
+        """
+        Save the downloaded image, or map the URL to the existing file, if the image wasn't modified.
+        """
+
+        try:
+            img_filename, tmp_img_path, img_size = future.result()
+            if tmp_img_path is None and not self._owns_file(state, img_url, img_filename):
+                # The existing file shows another image in the article, so this one is downloaded anew.
+                cached_img_filename = None
+                img_filename, tmp_img_path, img_size = self._download_image(img_url)
+        except Exception as e:
+            if self._skip_all_errors:
+                logger.warning('Warning: can\'t download image %d, error: [%s], '
+                               'but processing will be continued, because `skip_all_errors` flag is set',
+                               img_num + 1, e)
+                return
+            raise
+
+        if tmp_img_path is None:
+            logger.info('Image %d ["%s"] was not modified, the existing file is used...', img_num + 1, img_url)
+            self._map_image(state, img_url, img_filename)
+            return
+
+        try:
+            self._save_image(state, img_num, img_url, cached_img_filename, img_filename, tmp_img_path, img_size)
+        except BaseException:
+            tmp_img_path.unlink(missing_ok=True)
+            raise
+
+    def _select_images(self, images: List[str], state: '_DownloadState') -> list:
+        """
+        Filter out skipped images and fix URLs.
+
+        :return (image number, URL, existing file to refresh) for the images to download.
+        """
+
+        pending = []
+        for img_num, img_url in enumerate(images):
+            if img_url in self._skip_list or (self._skip_hosts and urlparse(img_url).netloc in self._skip_hosts):
+                logger.info('Image %d ["%s"] was skipped, because it\'s in the skip list...', img_num + 1, img_url)
                 continue
 
             if self._skip_on_existing_filename:
                 potential_filename = img_url.rsplit('/', 1)[1]
-                real_img_path = self._images_dir.joinpath(potential_filename)
-                try:
-                    if real_img_path.is_file():
-                        document_img_path = Path(self._images_dir.name, potential_filename)
-                        replacement_mapping.setdefault(img_url, document_img_path)
-                        print(f'Image {img_num + 1} ["{img_url}"] is skipped since there is an existing file...')
-                        continue
-                except OSError:
-                    pass
+                if potential_filename in state.existing_filenames:
+                    self._map_image(state, img_url, potential_filename)
+                    logger.info('Image %d ["%s"] is skipped since there is an existing file...', img_num + 1, img_url)
+                    continue
 
             if not is_url(img_url):
-                print(f'Image {img_num + 1} ["{img_url}"] has incorrect URL...')
+                logger.info('Image %d ["%s"] has incorrect URL...', img_num + 1, img_url)
                 if self._article_base_url:
-                    print(f'Trying to add base URL "{self._article_base_url}"...')
+                    logger.info('Trying to add base URL "%s"...', self._article_base_url)
                     img_url = f'{self._article_base_url}/{img_url}'
                 else:
-                    print('Image downloading will be skipped...')
+                    logger.info('Image downloading will be skipped...')
                     continue
 
-            print(f'Downloading image {img_num + 1} of {len(images)} from "{img_url}"...')
+            potential_filename = img_url.rsplit('/', 1)[1]
+            # The first image in the article keeps its name, whichever download finishes first.
+            state.filename_owners.setdefault(potential_filename, img_url)
+
+            # Existing file will be downloaded again only if the image was modified after it was saved.
+            cached_img_filename = None
+            if self._refresh_if_modified:
+                if state.filename_owners[potential_filename] != img_url:
+                    potential_filename = ImageDownloader._get_url_specific_filename(img_url, potential_filename)
+                if potential_filename in state.existing_filenames:
+                    cached_img_filename = potential_filename
+
+            pending.append((img_num, img_url, cached_img_filename))
+
+        return pending
+
+    def _owns_file(self, state: '_DownloadState', img_url: str, img_filename: str) -> bool:
+        """
+        Check that no other URL is mapped to the file.
+        """
+
+        return state.path_to_url.get(self._document_images_dir.joinpath(img_filename), img_url) == img_url
+
+    def _map_image(self, state: '_DownloadState', img_url: str, img_filename: str):
+        """
+        Point the image URL to the saved file, unless it's mapped already.
+        """
+
+        document_img_path = self._document_images_dir.joinpath(img_filename)
+        state.replacement_mapping.setdefault(img_url, document_img_path)
+        state.path_to_url.setdefault(document_img_path, img_url)
+
+    def _save_image(self, state: '_DownloadState', img_num: int, img_url: str, cached_img_filename: Optional[str],
+                    img_filename: str, tmp_img_path: Path, img_size: int):
+        """
+        Move downloaded image into the images directory, unless it's a duplicate of a saved image.
+        """
+
+        # Modified image replaces the outdated file, unless the file name is used by another URL:
+        # saved next to it, the image would be downloaded again on every run.
+        refreshed = cached_img_filename is not None and self._owns_file(state, img_url, cached_img_filename)
+        target_img_filename = cached_img_filename if refreshed else None
+
+        new_content_hash = None
+        if self._deduplication and not refreshed:
+            existing_img_filename, new_content_hash = self._find_duplicate(state, tmp_img_path, img_size)
+            if existing_img_filename is not None:
+                tmp_img_path.unlink()
+                self._map_image(state, img_url, existing_img_filename)
+                return
+
+        perceptual_hash = None
+        if self._perceptual_deduplication and not refreshed:
+            perceptual_hash = _get_perceptual_hash(tmp_img_path)
+            similar_image = self._find_similar_image(state.perceptual_hash_to_path, perceptual_hash)
+            if similar_image is not None:
+                similar_hash, similar_img_filename = similar_image
+                logger.info('Image %d ["%s"] is similar to "%s"...', img_num + 1, img_url, similar_img_filename)
+                if perceptual_hash.pixel_count <= similar_hash.pixel_count:
+                    tmp_img_path.unlink()
+                    self._map_image(state, img_url, similar_img_filename)
+                    return
+
+                # The larger copy takes the place of the saved one, whichever was downloaded first:
+                # the article mustn't get a thumbnail instead of the full-size image.
+                state.forget_image(similar_img_filename)
+                target_img_filename = similar_img_filename
+
+        if target_img_filename is not None:
+            img_filename = target_img_filename
+            os.replace(tmp_img_path, self._images_dir.joinpath(img_filename))
+        else:
+            img_filename = self._move_to_free_file(state, img_url, img_filename, tmp_img_path)
+
+        logger.info('Image is saved to "%s"...', self._images_dir.joinpath(img_filename))
+        self._map_image(state, img_url, img_filename)
+        state.existing_filenames.add(img_filename)
+
+        if self._deduplication:
+            if new_content_hash is None:
+                state.size_to_unhashed_filenames.setdefault(img_size, []).append(img_filename)
+            else:
+                state.hash_to_path_mapping[new_content_hash] = img_filename
+
+        if perceptual_hash is not None:
+            state.perceptual_hash_to_path.append((perceptual_hash, img_filename))
+
+    def _find_duplicate(self, state: '_DownloadState', tmp_img_path: Path, img_size: int):
+        """
+        Find saved image with the same content.
+
+        :return saved image filename (or None) and the image content hash, if it was computed.
+        """
+
+        # Images with different sizes can't be duplicates, so the content is hashed only
+        # when an image of the same size was saved already.
+        unhashed_filenames = state.size_to_unhashed_filenames.get(img_size)
+        if unhashed_filenames is None:
+            return None, None
+
+        while unhashed_filenames:
+            filename = unhashed_filenames.pop()
+            state.hash_to_path_mapping.setdefault(_get_file_hash(self._images_dir.joinpath(filename)), filename)
+
+        new_content_hash = _get_file_hash(tmp_img_path)
+        return state.hash_to_path_mapping.get(new_content_hash), new_content_hash
+
+    def _move_to_free_file(self, state: '_DownloadState', img_url: str, img_filename: str,
+                           tmp_img_path: Path) -> str:
+        """
+        Move downloaded image to a file, which doesn't collide with other images, or with the existing files
+        unless they're overwritten.
+
+        :return the image filename.
+        """
 
+        img_filename = self._get_unique_imge_filename(state, img_url, img_filename)
+        if self._overwrite:
+            os.replace(tmp_img_path, self._images_dir.joinpath(img_filename))
+            return img_filename
+
+        stem, suffix = Path(img_filename).stem, Path(img_filename).suffix
+        copy_num = 0
+        while True:
+            if img_filename not in state.existing_filenames:
+                real_img_path = self._images_dir.joinpath(img_filename)
+                # The name is reserved atomically: other processes may save images into the same directory.
+                try:
+                    os.close(os.open(real_img_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                except FileExistsError:
+                    state.existing_filenames.add(img_filename)
+                else:
+                    try:
+                        os.replace(tmp_img_path, real_img_path)
+                    except BaseException:
+                        real_img_path.unlink()
+                        raise
+                    return img_filename
+
+            # Several images with the same name may be saved within a second.
+            timestamp = strftime('%Y%m%d_%H%M%S')
+            img_filename = f'{stem}_{timestamp}_{copy_num}{suffix}' if copy_num else f'{stem}_{timestamp}{suffix}'
+            copy_num += 1
+
+        stem, suffix = Path(img_filename).stem, Path(img_filename).suffix
+        img_filename = f'{stem}_{strftime("%Y%m%d_%H%M%S")}{suffix}'
+        # Several images with the same name may be saved within a second.
+        copy_num = 1
+        while img_filename in state.existing_filenames:
+            img_filename = f'{stem}_{strftime("%Y%m%d_%H%M%S")}_{copy_num}{suffix}'
+            copy_num += 1
+
+        return img_filename
+
+    def _download_image(self, img_url: str, cached_img_filename: Optional[str] = None):
+        """
+        Download image into a temporary file in the images directory.
+
+        :param cached_img_filename: existing file, which is used if the image wasn't modified after it.
+        :return image filename, temporary file path and image size; no path and size if the existing file is used.
+        """
+
+        if cached_img_filename is not None:
+            img_mtime = self._images_dir.joinpath(cached_img_filename).stat().st_mtime
+            if not is_modified_since(img_url, img_mtime, self._downloading_timeout, self._session):
+                return cached_img_filename, None, None
+
+        img_response = download_from_url(img_url, self._downloading_timeout, self._session, stream=True)
+        with img_response:
+            img_filename = get_filename_from_url(img_response)
+            tmp_img_path = self._images_dir.joinpath(f'.{uuid4().hex}.part')
+            fd = os.open(tmp_img_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+            img_size = 0
             try:
-                img_response = download_from_url(img_url, self._downloading_timeout)
-            except Exception as e:
-                if self._skip_all_errors:
-                    print(f'Warning: can\'t download image {img_num + 1}, error: [{str(e)}], '
-                          'but processing will be continued, because `skip_all_errors` flag is set')
-                    continue
+                try:
+                    for chunk in img_response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        ImageDownloader._write_chunk(fd, chunk)
+                        img_size += len(chunk)
+                finally:
+                    os.close(fd)
+            except BaseException:
+                tmp_img_path.unlink()
                 raise
 
-            img_filename = get_filename_from_url(img_response)
-            image_content = img_response.content
-
-            if self._deduplication:
-                new_content_hash = hashlib.sha256(image_content).digest()
-                existing_img_filename = hash_to_path_mapping.get(new_content_hash)
-                if existing_img_filename is not None:
-                    document_img_path = Path(self._images_dir.name, existing_img_filename)
-                    replacement_mapping.setdefault(img_url, document_img_path)
-                    continue
-                else:
-                    hash_to_path_mapping[new_content_hash] = img_filename
+        return img_filename, tmp_img_path, img_size
 
-            img_filename = self._get_unique_imge_filename(replacement_mapping, img_url, img_filename)
+    @staticmethod
+    def _write_chunk(fd: int, data: bytes):
+        """
+        Write data into the file descriptor, bypassing Python's buffered file layer.
+        """
 
-            real_img_path = self._images_dir.joinpath(img_filename)
-            if real_img_path.is_file() and not self._overwrite:
-                img_filename = f'{real_img_path.stem}_{strftime("%Y%m%d_%H%M%S")}{real_img_path.suffix}'
-                real_img_path = self._images_dir.joinpath(img_filename)
+        written = os.write(fd, data)
+        # Regular files are written at once, short writes (e.g. interrupted by a signal) are finished here.
+        if written < len(data):
+            data = memoryview(data)[written:]
+            while data:
+                data = data[os.write(fd, data):]
 
-            document_img_path = Path(self._images_dir.name, img_filename)
-            replacement_mapping.setdefault(img_url, document_img_path)
+    @staticmethod
+    def _discard_downloads(futures):
+        """
+        Cancel pending downloads and remove temporary files of the finished ones.
+        """
 
-            ImageDownloader._write_image(real_img_path, image_content)
+        for future in futures:
+            future.cancel()
 
-        return OrderedDict(sorted(replacement_mapping.items(), reverse=True))
+        for future in futures:
+            if not future.cancelled() and future.exception() is None:
+                tmp_img_path = future.result()[1]
+                if tmp_img_path is not None:
+                    tmp_img_path.unlink(missing_ok=True)
 
     @staticmethod
-    def _write_image(img_path: os.PathLike, data: bytes):
+    def _find_similar_image(perceptual_hash_to_path, perceptual_hash: Optional[_PerceptualHash]):
         """
-        Write image data into the file.
+        Find saved image, which looks like the image with the given perceptual hash.
+
+        :return perceptual hash and filename of the saved image, or None.
         """
 
-        print(f'Image is saved to "{img_path}"...')
-        with open(img_path, 'wb') as img_file:
-            img_file.write(data)
-            img_file.close()
+        if perceptual_hash is None:
+            return None
+
+        for saved_hash, img_filename in perceptual_hash_to_path:
+            if (abs(perceptual_hash.aspect_ratio - saved_hash.aspect_ratio)
+                    <= PERCEPTUAL_ASPECT_RATIO_TOLERANCE * saved_hash.aspect_ratio
+                    and all(abs(c - sc) <= PERCEPTUAL_COLOUR_MAX_DISTANCE
+                            for c, sc in zip(perceptual_hash.mean_colour, saved_hash.mean_colour))
+                    and perceptual_hash.dhash - saved_hash.dhash <= PERCEPTUAL_HASH_MAX_DISTANCE):
+                return saved_hash, img_filename
 
-    def _get_unique_imge_filename(self, replacement_mapping, img_url, img_filename):
+        return None
+
+    def _get_unique_imge_filename(self, state: '_DownloadState', img_url, img_filename):
         """
         Fix path if a file with the similar name exists already.
         """
 
-        document_img_path = Path(self._images_dir.name, img_filename)
+        document_img_path = self._document_images_dir.joinpath(img_filename)
         # Images can have similar names but different URLs, here we'd like to save the original filenames if possible.
-        for url, path in replacement_mapping.items():
-            if document_img_path == path and img_url != url:
-                img_filename = (f'{document_img_path.stem}_'
-                                f'{hashlib.md5(img_url.encode()).hexdigest()}{document_img_path.suffix}')
-                break
+        existing_url = state.path_to_url.get(document_img_path) or state.filename_owners.get(img_filename)
+        if existing_url is not None and existing_url != img_url:
+            img_filename = ImageDownloader._get_url_specific_filename(img_url, img_filename)
 
         return img_filename
+
+    @staticmethod
+    def _get_url_specific_filename(img_url: str, img_filename: str) -> str:
+        img_path = Path(img_filename)
+        return f'{img_path.stem}_{hashlib.md5(img_url.encode()).hexdigest()}{img_path.suffix}'
@@ -5,6 +5,8 @@ Routines for the strings.
 import re
 import unicodedata
 
+from typing import Iterator
+
 
 def slugify(value):
     """
@@ -17,3 +19,12 @@ def slugify(value):
     value = re.sub(r'[-\s]+', '-', value)
 
     return value
+
+
+def encode_by_chunks(text: str, encoding: str = 'utf8', chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """
+    Encode text by chunks, so that the whole encoded copy of a large text is never held in memory.
+    """
+
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size].encode(encoding)
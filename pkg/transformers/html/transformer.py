@@ -2,12 +2,16 @@
 Images extractor from HTML document.
 """
 
+import logging
+
 from abc import ABC
 from html.parser import HTMLParser
-from typing import List, TextIO, Set
+from typing import List, Set
 
 __all__ = ['ArticleTransformer']
 
+logger = logging.getLogger(__name__)
+
 
 class HTMLImageURLGrabber(HTMLParser, ABC):
     def __init__(self):
@@ -16,11 +20,11 @@ class HTMLImageURLGrabber(HTMLParser, ABC):
 
     def handle_starttag(self, tag, attrs):
         if 'img' == tag:
-            print('Image was found...')
+            logger.info('Image was found...')
             for a in attrs:
                 if 'src' == a[0] and a[1] is not None:
                     img_url = a[1]
-                    print(f'Image URL: {img_url}...')
+                    logger.info('Image URL: %s...', img_url)
                     self._image_urls.append(img_url)
                     break
 
@@ -36,36 +40,30 @@ class ArticleTransformer:
 
     format = 'html'
 
-    def __init__(self, article_stream: TextIO, image_downloader):
+    def __init__(self, article_text: str, image_downloader):
         self._image_downloader = image_downloader
-        self._article_stream = article_stream
-        self._start_pos = self._article_stream.tell()
+        self._article_text = article_text
         self._html_images = HTMLImageURLGrabber()
-        self._image_downloader = image_downloader
         self._replacement_mapping = {}
 
     def _read_article(self) -> Set[str]:
-        self._html_images.feed(self._article_stream.read())
+        self._html_images.feed(self._article_text)
         images = self._html_images.image_urls
-        print(f'Images links count = {len(images)}')
+        logger.info('Images links count = %d', len(images))
         images = set(images)
-        print(f'Unique images links count = {len(images)}')
+        logger.info('Unique images links count = %d', len(images))
 
         return images
 
-    def _fix_document_urls(self) -> List[str]:
-        print('Replacing images urls in the document...')
-        replacement_mapping = self._replacement_mapping
-        lines = []
-        self._article_stream.seek(self._start_pos)
-        for line in self._article_stream:
-            for src, target in replacement_mapping.items():
-                line = line.replace(src, str(target))
-            lines.append(line)
+    def _fix_document_urls(self) -> str:
+        logger.info('Replacing images urls in the document...')
+        text = self._article_text
+        for src, target in self._replacement_mapping.items():
+            text = text.replace(src, str(target))
 
-        return lines
+        return text
 
-    def run(self):
+    def run(self) -> str:
         """
         Run article conversion.
         """
@@ -1,14 +1,17 @@
 """
 Images extractor from markdown document.
 """
+import logging
 import markdown
 
 from markdown.extensions import Extension
 from markdown.treeprocessors import Treeprocessor
-from typing import List, TextIO, Set
+from typing import Set
 
 __all__ = ['ArticleTransformer']
 
+logger = logging.getLogger(__name__)
+
 
 class ImgExtractor(Treeprocessor):
     def run(self, doc):
@@ -34,34 +37,30 @@ class ArticleTransformer:
 
     format = 'md'
 
-    def __init__(self, article_stream: TextIO, image_downloader):
+    def __init__(self, article_text: str, image_downloader):
         self._image_downloader = image_downloader
-        self._article_stream = article_stream
-        self._start_pos = self._article_stream.tell()
+        self._article_text = article_text
         self._md_conv = markdown.Markdown(extensions=[ImgExtExtension(), 'md_in_html'])
         self._md_conv.images = []
         self._replacement_mapping = {}
 
     def _read_article(self) -> Set[str]:
-        self._md_conv.convert(self._article_stream.read())
-        print(f'Images links count = {len(self._md_conv.images)}')
+        self._md_conv.convert(self._article_text)
+        logger.info('Images links count = %d', len(self._md_conv.images))
         images = set(self._md_conv.images)
-        print(f'Unique images links count = {len(images)}')
+        logger.info('Unique images links count = %d', len(images))
 
         return images
 
-    def _fix_document_urls(self) -> List[str]:
-        print('Replacing images urls in the document...')
-        lines = []
-        self._article_stream.seek(self._start_pos)
-        for line in self._article_stream:
-            for src, target in self._replacement_mapping.items():
-                line = line.replace(src, target.as_posix().replace(' ', '%20'))
-            lines.append(line)
+    def _fix_document_urls(self) -> str:
+        logger.info('Replacing images urls in the document...')
+        text = self._article_text
+        for src, target in self._replacement_mapping.items():
+            text = text.replace(src, target.as_posix().replace(' ', '%20'))
 
-        return lines
+        return text
 
-    def run(self):
+    def run(self) -> str:
         """
         Run article conversion.
         """
@@ -2,13 +2,17 @@
 Some functions useful for the working with URLs and network.
 """
 
+import logging
 import requests
 from typing import Optional
 import re
 import os
+from email.utils import formatdate
 from mimetypes import guess_extension
 from .string_tools import slugify
 
+logger = logging.getLogger(__name__)
+
 http_headers = {
     'user-agent': ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
                    'AppleWebKit/537.36 (KHTML, like Gecko) '
@@ -27,19 +31,23 @@ def is_url(url: str, allowed_url_prefixes=('http', 'ftp')) -> bool:
     return False
 
 
-def download_from_url(url: str, timeout=None):
+def download_from_url(url: str, timeout=None, session: Optional[requests.Session] = None, stream: bool = False):
     """
     Download file from the URL.
     :param url: URL to download.
     :param timeout: timeout before fail.
+    :param session: session to reuse connections from, `requests` module-level API is used if not set.
+    :param stream: don't read the content immediately, `iter_content()` must be used to get it.
     """
 
+    http = requests if session is None else session
+
     try:
-        response = requests.get(url, allow_redirects=True, timeout=timeout, headers=http_headers)
+        response = http.get(url, allow_redirects=True, timeout=timeout, headers=http_headers, stream=stream)
     except requests.exceptions.SSLError:
-        print('Incorrect SSL certificate, trying to download without verifying...')
-        response = requests.get(url, allow_redirects=True, verify=False,
-                                timeout=timeout)
+        logger.warning('Incorrect SSL certificate, trying to download without verifying...')
+        response = http.get(url, allow_redirects=True, verify=False,
+                            timeout=timeout, stream=stream)
 
     if response.status_code != 200:
         raise OSError(str(response))
@@ -47,6 +55,23 @@ def download_from_url(url: str, timeout=None):
     return response
 
 
+def is_modified_since(url: str, timestamp: float, timeout=None,
+                      session: Optional[requests.Session] = None) -> bool:
+    """
+    Check with a conditional HEAD request, if the file was modified after the given time.
+    :param url: URL to check.
+    :param timestamp: modification time of the local copy, seconds since the epoch.
+    :param timeout: timeout before fail.
+    :param session: session to reuse connections from, `requests` module-level API is used if not set.
+    """
+
+    http = requests if session is None else session
+    headers = {**http_headers, 'If-Modified-Since': formatdate(timestamp, usegmt=True)}
+    response = http.head(url, allow_redirects=True, timeout=timeout, headers=headers)
+
+    return response.status_code != 304
+
+
 def get_filename_from_url(req: requests.Response) -> Optional[str]:
     """
     Get filename from url and, if not found, try to get from content-disposition.